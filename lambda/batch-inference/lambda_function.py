@@ -0,0 +1,286 @@
+import boto3
+import json
+import os
+import logging
+
+from datetime import datetime, timedelta, timezone
+
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+# Reuse connections across warm invocations and retry throttled calls
+config = Config(
+    retries={"mode": "adaptive", "max_attempts": 5},
+    tcp_keepalive=True,
+    max_pool_connections=20,
+    read_timeout=80, # Long enough for an on-demand summary, well within the 5 minute function timeout
+    connect_timeout=3
+)
+
+s3_client = boto3.client("s3", config=config)
+bedrock_client = boto3.client("bedrock", config=config)
+# On-demand calls are not retried, a record that fails stays pending for the next
+# run, so a stalled call costs at most one read_timeout
+bedrock_runtime_client = boto3.client(
+    "bedrock-runtime",
+    config=config.merge(Config(retries={"mode": "adaptive", "total_max_attempts": 1}))
+)
+
+logger = logging.getLogger()
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
+
+PENDING_PREFIX = "batch-input/pending/"
+JOB_NAME_PREFIX = "summarizer-batch-"
+
+# Batch jobs that end in these states produce no output for (some of) their records
+FAILED_JOB_STATUSES = ["Failed", "Stopped", "Expired"]
+
+# How far back to look for failed batch jobs to requeue
+FAILED_JOB_LOOKBACK = timedelta(days=14)
+
+# Set by the stack from `-c model_id`, the same model `eventbridge-bedrock-inference` uses
+MODEL_ID = os.environ.get("MODEL_ID", "anthropic.claude-3-sonnet-20240229-v1:0")
+
+# Stop starting on-demand calls when less than this much of the function timeout is
+# left (one full read_timeout of the non-retried call plus headroom), the rest wait
+# for the next run
+ON_DEMAND_TIME_RESERVE_MS = 90 * 1000
+
+def list_pending_records(bucket):
+    """
+    List the JSONL records queued by `eventbridge-bedrock-inference`.
+
+    Args:
+        bucket (str): The bucket holding the `batch-input/pending/` prefix.
+
+    Returns:
+        list: The `list_objects_v2` entries (with `Key` and `LastModified`) of the queued records
+    """
+    records = []
+    paginator = s3_client.get_paginator("list_objects_v2")
+    for page in paginator.paginate(Bucket=bucket, Prefix=PENDING_PREFIX):
+        for obj in page.get("Contents", []):
+            if obj["Key"].endswith(".jsonl"):
+                records.append(obj)
+
+    return records
+
+def requeue_failed_jobs(bucket):
+    """
+    Return the records of batch jobs that failed, were stopped or expired to the
+    pending queue, so that the next batch job picks them up again. The job's manifest
+    is deleted once its records are requeued, so each job is only requeued once.
+
+    Args:
+        bucket (str): The bucket holding the `batch-input/` prefix.
+
+    Returns:
+        int: The number of records requeued
+    """
+    requeued = 0
+    submitted_after = datetime.now(timezone.utc) - FAILED_JOB_LOOKBACK
+
+    for status in FAILED_JOB_STATUSES:
+        kwargs = {"nameContains": JOB_NAME_PREFIX, "statusEquals": status, "submitTimeAfter": submitted_after}
+        while True:
+            response = bedrock_client.list_model_invocation_jobs(**kwargs)
+
+            for job in response.get("invocationJobSummaries", []):
+                manifest_key = f"batch-input/{job['jobName']}/records.jsonl"
+                try:
+                    body = s3_client.get_object(Bucket=bucket, Key=manifest_key)["Body"]
+                except ClientError as e:
+                    # Already requeued by an earlier run
+                    if e.response["Error"]["Code"] == "NoSuchKey":
+                        continue
+                    raise
+
+                for line in body.iter_lines():
+                    if not line:
+                        continue
+
+                    record_id = json.loads(line)["recordId"]
+                    s3_client.put_object(
+                        Body=line + b"\n",
+                        Bucket=bucket,
+                        Key=f"{PENDING_PREFIX}{record_id}.jsonl"
+                    )
+                    requeued += 1
+
+                s3_client.delete_object(Bucket=bucket, Key=manifest_key)
+                logger.warning("Batch inference job %s is %s, requeued its records", job["jobName"], status)
+
+            if "nextToken" not in response:
+                break
+            kwargs["nextToken"] = response["nextToken"]
+
+    return requeued
+
+def summarize_on_demand(bucket, records, context):
+    """
+    Summarize pending records with a synchronous `invoke_model` call, for records that
+    have waited too long for enough others to fill a batch job. Each record is removed
+    from the pending queue once its summary is written; records that fail, or that do
+    not fit in the remaining run time, stay pending for the next run.
+
+    Args:
+        bucket (str): The bucket holding the `batch-input/pending/` prefix.
+        records (list): The `list_objects_v2` entries of the records to summarize.
+        context: The Lambda context, used to stop before the function times out.
+
+    Returns:
+        list: The S3 keys of the summaries written
+    """
+    processed = []
+    for obj in records:
+        if context and context.get_remaining_time_in_millis() < ON_DEMAND_TIME_RESERVE_MS:
+            logger.warning("Out of time, leaving %s records pending", len(records) - len(processed))
+            break
+
+        try:
+            record = json.loads(s3_client.get_object(Bucket=bucket, Key=obj["Key"])["Body"].read())
+            response = bedrock_runtime_client.invoke_model(
+                modelId=MODEL_ID, body=json.dumps(record["modelInput"])
+            )
+            summary = json.loads(response["body"].read())["content"][0]["text"]
+
+            processed_key = f"processed/{record['recordId']}.txt"
+            s3_client.put_object(
+                Body=summary,
+                Bucket=bucket,
+                Key=processed_key
+            )
+            s3_client.delete_object(Bucket=bucket, Key=obj["Key"])
+        except (ClientError, BotoCoreError, KeyError, IndexError, TypeError, ValueError) as e:
+            # Timeouts, malformed records and unexpected responses only skip this record
+            logger.error("Error summarizing s3://%s/%s on demand: %s", bucket, obj["Key"], e)
+            continue
+
+        logger.info("Summary written to s3://%s/%s", bucket, processed_key)
+        processed.append(processed_key)
+
+    return processed
+
+def lambda_handler(event, context):
+    """
+    Runs on a schedule. Collects the pending JSONL records into a single manifest
+    under `batch-input/<job-name>/` and starts a Bedrock batch inference job on it.
+    Results are written to `batch-output/` and fanned out by `s3-trigger-batch-output`.
+    Records of earlier jobs that failed as a whole are requeued first.
+    """
+    BUCKET = os.environ["OUTPUT_BUCKET"]
+    ROLE_ARN = os.environ["BATCH_ROLE_ARN"]
+    MIN_RECORDS = int(os.environ.get("BATCH_MIN_RECORDS", "100"))
+    MAX_WAIT_MINUTES = int(os.environ.get("BATCH_MAX_WAIT_MINUTES", "60"))
+
+    logger.debug("# EVENT: %s", event)
+
+    try:
+        requeue_failed_jobs(BUCKET)
+    except (ClientError, BotoCoreError) as e:
+        # Try again on the next run, the pending records can still be processed
+        logger.error("Error requeuing failed batch inference jobs: %s", e)
+
+    records = list_pending_records(BUCKET)
+
+    # Bedrock rejects batch jobs below its minimum record count, so leave the
+    # records pending until the next scheduled run. Records that have waited longer
+    # than BATCH_MAX_WAIT_MINUTES are summarized on demand instead.
+    if len(records) < MIN_RECORDS:
+        cutoff = datetime.now(timezone.utc) - timedelta(minutes=MAX_WAIT_MINUTES)
+        stale = [obj for obj in records if obj["LastModified"] < cutoff]
+
+        if stale:
+            logger.warning("%s pending records are older than %s minutes, summarizing on demand", len(stale), MAX_WAIT_MINUTES)
+            processed = summarize_on_demand(BUCKET, stale, context)
+            return {
+                "statusCode": 200,
+                "body": processed
+            }
+
+        logger.info("%s pending records, waiting for %s", len(records), MIN_RECORDS)
+        return {
+            "statusCode": 200,
+            "body": f"{len(records)} pending records, waiting for {MIN_RECORDS}"
+        }
+
+    keys = [obj["Key"] for obj in records]
+
+    job_name = JOB_NAME_PREFIX + datetime.now(timezone.utc).strftime("%Y%m%d%H%M%S")
+    manifest_key = f"batch-input/{job_name}/records.jsonl"
+
+    try:
+        records = []
+        for key in keys:
+            record = s3_client.get_object(Bucket=BUCKET, Key=key)["Body"].read().decode("utf-8")
+            records.append(record if record.endswith("\n") else record + "\n")
+
+        s3_client.put_object(
+            Body="".join(records),
+            Bucket=BUCKET,
+            Key=manifest_key
+        )
+        logger.info("Wrote %s records to s3://%s/%s", len(records), BUCKET, manifest_key)
+    except ClientError as e:
+        logger.error("Error writing batch manifest to s3://%s/%s: %s", BUCKET, manifest_key, e)
+        return {
+            "statusCode": 400,
+            "body": f"Error writing batch manifest to s3://{BUCKET}/{manifest_key}: {e}"
+        }
+
+    try:
+        logger.info("## CREATING MODEL INVOCATION JOB")
+        response = bedrock_client.create_model_invocation_job(
+            jobName=job_name,
+            modelId=MODEL_ID,
+            roleArn=ROLE_ARN,
+            inputDataConfig={
+                "s3InputDataConfig": {
+                    "s3Uri": f"s3://{BUCKET}/batch-input/{job_name}/"
+                }
+            },
+            outputDataConfig={
+                "s3OutputDataConfig": {
+                    "s3Uri": f"s3://{BUCKET}/batch-output/"
+                }
+            }
+        )
+    except ClientError as e:
+        logger.error(e)
+        return {
+            "statusCode": 400,
+            "body": str(e)
+        }
+
+    # The records are now part of the manifest, remove them from the pending queue
+    for i in range(0, len(keys), 1000):
+        s3_client.delete_objects(
+            Bucket=BUCKET,
+            Delete={"Objects": [{"Key": key} for key in keys[i:i + 1000]], "Quiet": True}
+        )
+
+    logger.info("Batch inference job created: %s", response["jobArn"])
+    return {
+        "statusCode": 200,
+        "body": response["jobArn"]
+    }
+
+if __name__ == "__main__":
+
+    # Sample event and env vars
+    os.environ['OUTPUT_BUCKET'] = "<my-bucket>"
+    os.environ['BATCH_ROLE_ARN'] = "<my-batch-role-arn>"
+    event = {
+        "version": "0",
+        "id": "53dc...",
+        "detail-type": "Scheduled Event",
+        "source": "aws.events",
+        "account": "...",
+        "time": "2024-04-27T14:15:00Z",
+        "region": "us-east-1",
+        "resources": [],
+        "detail": {}
+    }
+
+    response = lambda_handler(event, None)
+    print(response)
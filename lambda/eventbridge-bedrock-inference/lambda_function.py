@@ -1,94 +1,182 @@
 import boto3
-import json
-import sys
-import tempfile
+import ijson
+import orjson
 import os
+import re
 import logging
 
+from concurrent.futures import ThreadPoolExecutor
+
+from botocore.config import Config
 from botocore.exceptions import ClientError
 
-transcribe = boto3.client("transcribe")
-s3_client = boto3.client("s3")
-bedrock_client = boto3.client("bedrock-runtime")
+# Reuse connections across warm invocations and retry throttled calls
+config = Config(
+    retries={"mode": "adaptive", "max_attempts": 5},
+    tcp_keepalive=True,
+    max_pool_connections=20,
+    read_timeout=50, # Fail a stalled read well within the function timeout
+    connect_timeout=3
+)
 
-logger = logging.getLogger()
-logger.setLevel("INFO")
+s3_client = boto3.client("s3", config=config)
+bedrock_client = boto3.client("bedrock-runtime", config=config)
 
-def convert_to_txt_file(json_file):
+logger = logging.getLogger()
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
+
+# Prepare a prompt for summarization. The prompt (and `system` prompt below)
+# are hardcoded here. Ideally, these would be dynamic or configurable by your user.
+PROMPT_TMPL = """Summarize the following transcript into one or more clear and
+readable paragraphs. When you summarize, capture any ideas discussed, any hot
+topics you identify, or any other interesting parts of the conversation between
+the speakers. At the end of your summary, give a bullet point list of the key
+action items, to-do's, and followup activities:
+
+{transcript}
+"""
+
+SYSTEM_PROMPT = "You are an AI assistant that excels at summarizing conversations."
+
+# Set by the stack from `-c model_id`, the default is Anthropic Claude 3 Sonnet
+MODEL_ID = os.environ.get("MODEL_ID", "anthropic.claude-3-sonnet-20240229-v1:0")
+
+# Setting default parameters for the model, adjust as needed:
+INFERENCE_CONFIG = {
+    "maxTokens": 2000,
+    "temperature": 1.0,
+    "topP": 0.999
+}
+
+# Model specific parameters that the Converse API does not cover. top_k is only
+# accepted by Anthropic models (including inference profiles like "us.anthropic...")
+ANTHROPIC_REQUEST_FIELDS = {
+    "top_k": 40
+}
+ADDITIONAL_MODEL_REQUEST_FIELDS = ANTHROPIC_REQUEST_FIELDS if "anthropic." in MODEL_ID else {}
+
+# Batch inference and the Step Functions workflow send the model's native request
+# body, so the same parameters are kept in the Anthropic Claude Messages API format
+BODY_BASE = {
+    "anthropic_version": "bedrock-2023-05-31",
+    "max_tokens": INFERENCE_CONFIG["maxTokens"],
+    "system": SYSTEM_PROMPT,
+    "temperature": INFERENCE_CONFIG["temperature"],
+    "top_p": INFERENCE_CONFIG["topP"],
+    **ANTHROPIC_REQUEST_FIELDS
+}
+
+# Transcribe labels speakers "spk_0", "spk_1", ..., which are renamed to "Speaker 1", "Speaker 2", ...
+_SPK_RE = re.compile(r"spk_(\d+)")
+
+# The maximum number of batched SQS messages summarized at the same time
+MAX_CONCURRENCY = 5
+
+def _speaker_name(match):
+    return f"Speaker {int(match.group(1)) + 1}"
+
+def convert_to_txt(body_stream):
     """
-    Convert the JSON output of Amazon Transcribe to plaintext format, and write it to a file.
+    Convert the JSON output of Amazon Transcribe to plaintext format.
 
     Args:
-        json_file (str): Path to the JSON file with the default Transcribe output.
+        body_stream: A file-like object with the default Transcribe output, such as
+            the `StreamingBody` returned by `s3_client.get_object`.
 
     Returns:
-        str: The converted transcript
-        str: The path to the output text file or None
+        list: The lines of the converted transcript or None
     """
-    try:
-        with open(json_file, "r") as f:
-            data = json.load(f)
-    except json.decoder.JSONDecodeError:
-        
-        logger.error("File is not a valid JSON file")
-        return None
-
-    # Save the converted output to a tempoary file
-    temp_file = tempfile.NamedTemporaryFile(dir="/tmp", suffix=".txt", delete=False)
-    output_path = temp_file.name
-
     current_speaker = None
-    current_text = ""
+    current_tokens = []
     output = []
 
-    with open(output_path, "w", encoding="utf-8") as output_file:
-        for item in data["results"].get("items", []):
-            if item["type"] == "pronunciation":
-                content = item["alternatives"][0]["content"]
+    # Bind the hot-loop methods to locals once
+    output_append = output.append
+    tokens_append = current_tokens.append
+    speaker_sub = _SPK_RE.sub
+
+    try:
+        # Parse the items one at a time instead of loading the entire document
+        for item in ijson.items(body_stream, "results.items.item"):
+            item_type = item["type"]
+            content = item["alternatives"][0]["content"]
+
+            if item_type == "pronunciation":
                 speaker_label = item["speaker_label"]
 
                 if speaker_label != current_speaker:
-                    if current_text:
-                        output_file.write(f"{current_speaker}: {current_text.strip()}\n")
-                        output.append(f"{current_speaker}: {current_text.strip()}\n")
+                    if current_tokens:
+                        output_append(f"{speaker_sub(_speaker_name, current_speaker)}: {' '.join(current_tokens).strip()}\n")
+                        current_tokens.clear()
                     current_speaker = speaker_label
-                    current_text = content
-                else:
-                    current_text += " " + content
-            elif item["type"] == "punctuation":
-                current_text += item["alternatives"][0]["content"]
 
-        if current_text:
-            output_file.write(f"{speaker_label}: {current_text.strip()}\n")
-            output.append(f"{speaker_label}: {current_text.strip()}\n")
+                tokens_append(content)
+            elif item_type == "punctuation" and current_tokens:
+                # Punctuation attaches to the preceding word
+                current_tokens[-1] += content
+
+        if current_tokens:
+            output_append(f"{speaker_sub(_speaker_name, current_speaker)}: {' '.join(current_tokens).strip()}\n")
+    except ijson.JSONError:
+
+        logger.error("File is not a valid JSON file")
+        return None
 
-    return "".join(output), output_path
+    return output
 
-def download_file(url):
-    """Downloads a text file from the url and saves it to a temporary file.
+def build_request_body(transcript):
+    """
+    Build the Bedrock request body that asks the model to summarize a transcript.
 
     Args:
-        url: The url of the text file to download.
+        transcript (str): The converted transcript.
 
     Returns:
-        The path to the downloaded temporary file, or None if download fails.
+        dict: The request body
     """
-    try:
-        response = requests.get(url)
+    # Claude requires the "Anthropic Claude Messages API" format,
+    # https://docs.aws.amazon.com/bedrock/latest/userguide/model-parameters-anthropic-claude-messages.html
+    return {
+        **BODY_BASE,
+        "messages": [
+            {
+                "role": "user",
+                "content": [
+                    {
+                        "type": "text",
+                        "text": PROMPT_TMPL.format(transcript=transcript),
+                    }
+                ]
+            }
+        ]
+    }
 
-        with tempfile.NamedTemporaryFile(dir="/tmp", suffix="") as temp_file:
-            temp_file.write(response.content)
-            logger.info(f"Downloaded URL to {temp_file.name}")
-            return temp_file.name
+def collect_summary(stream):
+    """
+    Collect the text of a streamed model response. The summary is written with a
+    single `put_object` once it is complete, since a summary never approaches the
+    5 MiB minimum part size a multipart upload would need to overlap with generation.
 
-    except requests.exceptions.RequestException as e:
-        
-        logger.error(f"Download failed: {e}")
-        return None
+    Args:
+        stream: The `stream` event stream of `converse_stream`.
 
-def lambda_handler(event, context):
+    Returns:
+        str: The complete summary
     """
-    Ingests the URI from the transcription job and converts the output 
+    summary = []
+    for event in stream:
+        if "contentBlockDelta" not in event:
+            continue
+
+        text = event["contentBlockDelta"]["delta"].get("text")
+        if text:
+            summary.append(text)
+
+    return "".join(summary)
+
+def summarize_transcription(event):
+    """
+    Ingests the URI from the completed transcription job and converts the output 
     from Transcribe's default format to our custom format. Writes the
     converted transcription to S3, and use Bedrock to invoke a model for
     summarization.
@@ -97,172 +185,180 @@ def lambda_handler(event, context):
 
     if event and "detail" in event:
 
-        logger.info("# EVENT")
-        logger.info(event)
+        logger.debug("# EVENT: %s", event)
 
         transcription_job_name = event["detail"]["TranscriptionJobName"]
+        transcription_job_name_txt = transcription_job_name + ".txt"
+
+        # EventBridge may deliver the same event more than once, skip jobs that
+        # have already been summarized
+        try:
+            s3_client.head_object(Bucket=BUCKET, Key=f"processed/{transcription_job_name_txt}")
+            logger.info("Summary already exists at s3://%s/processed/%s", BUCKET, transcription_job_name_txt)
+            return {
+                "statusCode": 200,
+                "body": "cached"
+            }
+        except ClientError as e:
+            if e.response["Error"]["Code"] != "404":
+                raise
+
+        # Stream the file from S3
+        try:
+            transcript_body = s3_client.get_object(
+                Bucket=BUCKET,
+                Key="transcription/" + transcription_job_name + ".json"
+            )["Body"]
+            logger.info("Reading %s.json from %s", transcription_job_name, BUCKET)
+        except ClientError as e:
+            
+            logger.error("Error downloading s3://%s/transcription/%s.json: %s", BUCKET, transcription_job_name, e)
+            return {
+                "statusCode": 400,
+                "body": f"Error downloading s3://{BUCKET}/transcription/{transcription_job_name}.json: {e}"
+            }
 
-        job = transcribe.get_transcription_job(
-            TranscriptionJobName=transcription_job_name
-        )
+        # Convert to txt
+        lines = convert_to_txt(transcript_body)
+        if lines is None:
+            
+            logger.error("Error converting transcription to txt file")
+            return {
+                "statusCode": 400,
+                "body": "Error converting transcription to txt file"
+            }
 
-        if event["detail"]["TranscriptionJobStatus"] in ["COMPLETED"]:
+        logger.info("Converted transcription %s", transcription_job_name)
 
-            response = transcribe.get_transcription_job(
-                TranscriptionJobName=transcription_job_name
+        # Join the lines once, the same string is uploaded and used for the prompt.
+        # It is only encoded for the upload, so no bytes copy outlives put_object.
+        transcript_content = "".join(lines)
+        del lines
+
+        # Save the transcription to S3 so it can be referenced or reviewed at a later time
+        try:
+            s3_client.put_object(
+                Body=transcript_content.encode("utf-8"),
+                Bucket=BUCKET,
+                Key="transcription/" + transcription_job_name_txt
             )
+            logger.info("Uploaded to s3://%s/transcription/%s", BUCKET, transcription_job_name_txt)
+        except Exception as e:
+            
+            logger.error("Error uploading converted file to s3://%s/transcription/%s: %s", BUCKET, transcription_job_name_txt, e)
+            return {
+                "statusCode": 400,
+                "body": f"Error uploading converted file to s3://{BUCKET}/transcription/{transcription_job_name_txt}: {e}"
+            }
 
-            # Get the file from S3
+        # In batch mode, queue the request as a JSONL record for the next Bedrock
+        # batch inference job instead of invoking the model synchronously. The
+        # `batch-inference` function launches the job on a schedule, and the
+        # `s3-trigger-batch-output` function writes the results to `processed/`.
+        if os.environ.get("BATCH_INFERENCE", "false").lower() == "true":
+            pending_key = f"batch-input/pending/{transcription_job_name}.jsonl"
             try:
-                s3_client.download_file(BUCKET, "transcription/" + transcription_job_name + ".json", "/tmp/" + transcription_job_name + ".json")
-                logger.info(f"Downloaded {transcription_job_name}.json from {BUCKET}")
+                s3_client.put_object(
+                    Body=orjson.dumps({"recordId": transcription_job_name, "modelInput": build_request_body(transcript_content)}) + b"\n",
+                    Bucket=BUCKET,
+                    Key=pending_key
+                )
+                logger.info("Queued batch inference record to s3://%s/%s", BUCKET, pending_key)
             except ClientError as e:
-                
-                logger.error(f"Error downloading s3://{BUCKET}/transcription/{transcription_job_name}.json: {e}")
+                logger.error("Error queueing batch inference record to s3://%s/%s: %s", BUCKET, pending_key, e)
                 return {
                     "statusCode": 400,
-                    "body": f"Error downloading s3://{BUCKET}/transcription/{transcription_job_name}.json: {e}"
+                    "body": f"Error queueing batch inference record to s3://{BUCKET}/{pending_key}: {e}"
                 }
 
-            # Convert to txt file
-            transcript_content, transcript_output_file = convert_to_txt_file("/tmp/" + transcription_job_name + ".json")
-            if not transcript_output_file or not os.path.exists(transcript_output_file):
-                
-                logger.error("Error converting transcription to txt file")
-                return {
-                    "statusCode": 400,
-                    "body": "Error converting transcription to txt file"
-                }
+            return {
+                "statusCode": 200,
+                "body": pending_key
+            }
 
-            logger.info(f"Converted transcription to {transcript_output_file}")
+        # Only send the optional parameters that apply to this deployment
+        options = {}
+        if ADDITIONAL_MODEL_REQUEST_FIELDS:
+            options["additionalModelRequestFields"] = ADDITIONAL_MODEL_REQUEST_FIELDS
+
+        # "optimized" routes to latency-optimized capacity on the models and regions
+        # that support it. performanceConfig is only sent then, so the default call
+        # also works with runtime botocore versions that predate the parameter.
+        if os.environ.get("PERFORMANCE_LATENCY", "standard") == "optimized":
+            options["performanceConfig"] = {"latency": "optimized"}
+
+        # The Converse API uses the same request format for every Bedrock model,
+        # https://docs.aws.amazon.com/bedrock/latest/userguide/conversation-inference.html
+        try:
+            logger.info("## INVOKING MODEL")
+            response = bedrock_client.converse_stream(
+                modelId=MODEL_ID,
+                system=[{"text": SYSTEM_PROMPT}],
+                messages=[
+                    {
+                        "role": "user",
+                        "content": [
+                            {
+                                "text": PROMPT_TMPL.format(transcript=transcript_content)
+                            }
+                        ]
+                    }
+                ],
+                inferenceConfig=INFERENCE_CONFIG,
+                **options
+            )
+        except ClientError as e:
+            logger.error(e)
+            return {
+                "statusCode": 400,
+                "body": str(e)
+            }
 
-            # Save the transcription to S3 so it can be referenced or reviewed at a later time
-            try:
-                transcription_job_name_txt = transcription_job_name + ".txt"
-                s3_client.upload_file(transcript_output_file, BUCKET, "transcription/" + transcription_job_name_txt)
-                logger.info(f"Uploaded to s3://{BUCKET}/transcription/{transcription_job_name_txt}")
-            except Exception as e:
-                
-                logger.error(f"Error uploading converted file to s3://{BUCKET}/transcription/{transcription_job_name_txt}: {e}")
+        if response["ResponseMetadata"]["HTTPStatusCode"] != 200:
+            if "stream" in response:
                 return {
-                    "statusCode": 400,
-                    "body": f"Error uploading converted file to s3://{BUCKET}/transcription/{transcription_job_name_txt}: {e}"
+                    "statusCode": response["ResponseMetadata"]["HTTPStatusCode"],
+                    "body": str(response["stream"])
                 }
-
-            # Prepare a prompt for summarization. The prompt (and `system` prompt below) 
-            # are hardcoded here. Ideally, these would be dynamic or configurable by your user.
-            prompt = f"""Summarize the following transcript into one or more clear and 
-            readable paragraphs. Speakers in the transcript could be denoted by their name,
-            or by "spk_x", where `x` is a number. These represent distinct speakers in the 
-            conversation. When you refer to a speaker, you may refer to them by "Speaker 1"
-            in the case of "spk_1", "Speaker 2" in the case of "spk_2", and so forth. 
-            When you summarize, capture any ideas discussed, any hot topics you identify, 
-            or any other interesting parts of the conversation between the speakers. 
-            At the end of your summary, give a bullet point list of the key action 
-            items, to-do's, and followup activities:
-            
-            {transcript_content}
-            """
-
-            # Claude requires the "Anthropic Claude Messages API" format,
-            # https://docs.aws.amazon.com/bedrock/latest/userguide/model-parameters-anthropic-claude-messages.html
-            messages = [
-                {
-                    "role": "user",
-                    "content": [
-                        {
-                            "type": "text",
-                            "text": prompt,
-                        }
-                    ]
-                }
-            ]
-
-            # Setting default parameters for the model, adjust as needed:
-            body = json.dumps(
-                {
-                    "anthropic_version": "bedrock-2023-05-31",
-                    "max_tokens": 2000,
-                    "system": "You are an AI assistant that excels at summarizing conversations.",
-                    "messages": messages,
-                    "temperature": 1.0,
-                    "top_p": 0.999,
-                    "top_k": 40
+            else:
+                logger.error(response)
+                return {
+                    "statusCode": response["ResponseMetadata"]["HTTPStatusCode"],
+                    "body": "An unknown error occured."
                 }
-            )
-
-            # By default this uses Anthropic Claude 3 Sonnet, but you can change to other
-            # models available to you.
+        else:
             try:
-                logger.info("## INVOKING MODEL")
-                response = bedrock_client.invoke_model(
-                    modelId="anthropic.claude-3-sonnet-20240229-v1:0", body=body
-                )
+                summary = collect_summary(response["stream"])
             except ClientError as e:
+                # Errors raised mid-stream (e.g. throttling) arrive as EventStreamError
                 logger.error(e)
                 return {
                     "statusCode": 400,
                     "body": str(e)
                 }
 
-            if response["ResponseMetadata"]["HTTPStatusCode"] != 200:
-                if "body" in response:
-                    return {
-                        "statusCode": response["ResponseMetadata"]["HTTPStatusCode"],
-                        "body": str(response["body"])
-                    }
-                else:
-                    logger.error(response)
-                    return {
-                        "statusCode": response["ResponseMetadata"]["HTTPStatusCode"],
-                        "body": "An unknown error occured."
-                    }
-            else:
-                response_body = json.loads(response["body"].read())
-
-                # Debug a preview of the Bedrock output
-                logger.info("## BEDROCK OUTPUT PREVIEW")
-                logger.info(json.dumps(response_body["content"][0]["text"][0:100] + "..."))
-                summary = response_body["content"][0]["text"]
-
-                # Write the summary to an S3 file
-                processed_key = f"processed/{transcription_job_name_txt}"
-                s3_response = s3_client.put_object(
+            # Write the summary to an S3 file
+            processed_key = f"processed/{transcription_job_name_txt}"
+            try:
+                s3_client.put_object(
                     Body=summary,
                     Bucket=BUCKET,
                     Key=processed_key
                 )
+            except ClientError as e:
+                logger.error("Error writing summary to s3://%s/%s: %s", BUCKET, processed_key, e)
+                return {
+                    "statusCode": 400,
+                    "body": f"Error writing summary to s3://{BUCKET}/{processed_key}: {e}"
+                }
 
-                if s3_response["ResponseMetadata"]["HTTPStatusCode"] != 200:
-                    logger.error(s3_response)
-                    return {
-                        "statusCode": s3_response["ResponseMetadata"]["HTTPStatusCode"],
-                        "body": str(s3_response)
-                    }
-                else:
-                    logger.info(f"Summary written to s3://{BUCKET}/{processed_key}")
-                    return {
-                        "statusCode": 200,
-                        "body": processed_key
-                    }
+            # Debug a preview of the Bedrock output
+            logger.debug("## BEDROCK OUTPUT PREVIEW: %s...", summary[:100])
 
+            logger.info("Summary written to s3://%s/%s", BUCKET, processed_key)
             return {
                 "statusCode": 200,
-                "body": f"s3://{BUCKET}/transcription/{transcription_job_name_txt}"
-            }
-
-        elif event["detail"]["TranscriptionJobStatus"] in ["FAILED"]:
-            logger.error(f"Unable to process, job {transcription_job_name} failed.")
-            return {
-                "statusCode": 400,
-                "body": f"Unable to process, job {transcription_job_name} failed."
-            }
-
-        else:
-            logger.error(f"Transcription job {transcription_job_name} is not completed or failed.")
-            return {
-                "statusCode": 500,
-                "body": f"Transcription job {transcription_job_name} is not completed or failed."
+                "body": processed_key
             }
 
     else:
@@ -273,6 +369,83 @@ def lambda_handler(event, context):
             "body": "Invalid event received."
         }
 
+def parse_handler(event, context):
+    """
+    The first task of the Step Functions workflow. Converts the transcription job's
+    output to our custom format and writes it to S3, then returns the Bedrock request
+    body for the state machine to invoke the model with. Errors are raised so that
+    the execution fails.
+    """
+    BUCKET = os.environ["OUTPUT_BUCKET"]
+
+    logger.debug("# EVENT: %s", event)
+
+    transcription_job_name = event["detail"]["TranscriptionJobName"]
+    processed_key = f"processed/{transcription_job_name}.txt"
+
+    # EventBridge may deliver the same event more than once, let the state
+    # machine skip jobs that have already been summarized
+    try:
+        s3_client.head_object(Bucket=BUCKET, Key=processed_key)
+        logger.info("Summary already exists at s3://%s/%s", BUCKET, processed_key)
+        return {
+            "processed_key": processed_key,
+            "cached": True
+        }
+    except ClientError as e:
+        if e.response["Error"]["Code"] != "404":
+            raise
+
+    transcript_body = s3_client.get_object(
+        Bucket=BUCKET,
+        Key="transcription/" + transcription_job_name + ".json"
+    )["Body"]
+
+    lines = convert_to_txt(transcript_body)
+    if lines is None:
+        raise ValueError(f"Error converting transcription {transcription_job_name} to txt file")
+
+    transcript_content = "".join(lines)
+    del lines
+
+    s3_client.put_object(
+        Body=transcript_content.encode("utf-8"),
+        Bucket=BUCKET,
+        Key="transcription/" + transcription_job_name + ".txt"
+    )
+    logger.info("Uploaded to s3://%s/transcription/%s.txt", BUCKET, transcription_job_name)
+
+    return {
+        "processed_key": processed_key,
+        "cached": False,
+        "body": build_request_body(transcript_content)
+    }
+
+def lambda_handler(event, context):
+    """
+    Receives Transcribe job state change events from EventBridge, either directly
+    or batched through SQS. Batched events are summarized concurrently, and any
+    that fail are reported back to SQS as partial batch failures to be retried.
+    """
+    if not event or "Records" not in event:
+        return summarize_transcription(event)
+
+    def process_record(record):
+        try:
+            response = summarize_transcription(orjson.loads(record["body"]))
+        except Exception as e:
+            logger.error("Error processing message %s: %s", record["messageId"], e)
+            return record["messageId"]
+
+        return None if response["statusCode"] == 200 else record["messageId"]
+
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENCY) as executor:
+        failed = [message_id for message_id in executor.map(process_record, event["Records"]) if message_id]
+
+    return {
+        "batchItemFailures": [{"itemIdentifier": message_id} for message_id in failed]
+    }
+
 if __name__ == "__main__":
 
     # Sample event and env vars
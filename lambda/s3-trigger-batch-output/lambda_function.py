@@ -0,0 +1,149 @@
+import boto3
+import json
+import os
+import logging
+import urllib.parse
+
+from botocore.config import Config
+from botocore.exceptions import ClientError
+
+# Reuse connections across warm invocations and retry throttled calls
+config = Config(
+    retries={"mode": "adaptive", "max_attempts": 5},
+    tcp_keepalive=True,
+    max_pool_connections=20,
+    read_timeout=20, # Fail a stalled read well within the 60 second function timeout
+    connect_timeout=3
+)
+
+s3_client = boto3.client("s3", config=config)
+
+logger = logging.getLogger()
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
+
+PENDING_PREFIX = "batch-input/pending/"
+
+def is_retryable(error):
+    """
+    Whether a record that failed inside a batch job is worth queueing again. Client
+    errors (other than timeouts and throttling) fail the same way on every attempt.
+
+    Args:
+        error (dict): The `error` object of the failed output record, if any.
+
+    Returns:
+        bool: False for non-retryable client errors, True otherwise
+    """
+    try:
+        code = int((error or {}).get("errorCode"))
+    except (TypeError, ValueError):
+        return True
+
+    return not (400 <= code < 500 and code not in (408, 429))
+
+def lambda_handler(event, context):
+    """
+    Receives an event from S3 when a Bedrock batch inference job writes its
+    `.jsonl.out` results to `batch-output/`, and writes each summary to the
+    `processed` folder under the Transcribe job name it was queued with. Records
+    that failed with a retryable error are written back to `batch-input/pending/`
+    for the next batch job.
+    """
+    BUCKET = os.environ["OUTPUT_BUCKET"]
+
+    logger.debug("# EVENT: %s", event)
+
+    bucket = event["Records"][0]["s3"]["bucket"]["name"]
+    key = urllib.parse.unquote_plus(event["Records"][0]["s3"]["object"]["key"])
+
+    try:
+        body = s3_client.get_object(Bucket=bucket, Key=key)["Body"]
+    except ClientError as e:
+        logger.error("Error downloading s3://%s/%s: %s", bucket, key, e)
+        return {
+            "statusCode": 400,
+            "body": f"Error downloading s3://{bucket}/{key}: {e}"
+        }
+
+    processed = []
+    requeued = []
+    failed = []
+    for line in body.iter_lines():
+        if not line:
+            continue
+
+        record = json.loads(line)
+        transcription_job_name = record["recordId"]
+
+        if "modelOutput" not in record:
+            error = record.get("error")
+            if not is_retryable(error):
+                logger.error("Batch inference failed for %s: %s", transcription_job_name, error)
+                failed.append(transcription_job_name)
+                continue
+
+            # Errors are raised so that the asynchronous invocation is retried
+            # rather than the record being lost
+            pending_key = f"{PENDING_PREFIX}{transcription_job_name}.jsonl"
+            s3_client.put_object(
+                Body=json.dumps({"recordId": transcription_job_name, "modelInput": record["modelInput"]}) + "\n",
+                Bucket=BUCKET,
+                Key=pending_key
+            )
+            logger.warning("Batch inference failed for %s, requeued to s3://%s/%s: %s", transcription_job_name, BUCKET, pending_key, error)
+            requeued.append(pending_key)
+            continue
+
+        summary = record["modelOutput"]["content"][0]["text"]
+
+        # Write the summary to an S3 file
+        processed_key = f"processed/{transcription_job_name}.txt"
+        s3_client.put_object(
+            Body=summary,
+            Bucket=BUCKET,
+            Key=processed_key
+        )
+        logger.info("Summary written to s3://%s/%s", BUCKET, processed_key)
+        processed.append(processed_key)
+
+    if failed:
+        return {
+            "statusCode": 400,
+            "body": f"Batch inference failed for: {', '.join(failed)}"
+        }
+
+    if requeued:
+        logger.info("Requeued %s records", len(requeued))
+
+    return {
+        "statusCode": 200,
+        "body": processed
+    }
+
+if __name__ == "__main__":
+
+    # Sample event and env vars
+    os.environ['OUTPUT_BUCKET'] = "<my-bucket>"
+    event = {
+        "Records": [{
+            "eventVersion": "2.1",
+            "eventSource": "aws:s3",
+            "awsRegion": "us-east-1",
+            "eventTime": "2024-04-27T16:10:19.042Z",
+            "eventName": "ObjectCreated:Put",
+            "s3": {
+                "s3SchemaVersion": "1.0",
+                "bucket": {
+                    "name": "<bucket-name>",
+                    "arn": "<bucket-arn>"
+                },
+                "object": {
+                    "key": "batch-output/<job-id>/records.jsonl.out",
+                    "size": 42000
+                }
+            }
+        }]
+    }
+
+    response = lambda_handler(event, None)
+    print(response)
@@ -5,10 +5,21 @@ import string
 import os
 import logging
 
+from botocore.config import Config
+
 logger = logging.getLogger()
-logger.setLevel("INFO")
+logger.setLevel(os.environ.get("LOG_LEVEL", "INFO"))
+
+# Reuse connections across warm invocations and retry throttled calls
+config = Config(
+    retries={"mode": "adaptive", "max_attempts": 5},
+    tcp_keepalive=True,
+    max_pool_connections=20,
+    read_timeout=5, # Fail a stalled read well within the 15 second function timeout
+    connect_timeout=3
+)
 
-transcribe = boto3.client("transcribe")
+transcribe = boto3.client("transcribe", config=config)
 
 def lambda_handler(event, context):
     """
@@ -16,8 +27,7 @@ def lambda_handler(event, context):
     event object as the job media.
     """
 
-    logger.info("# EVENT")
-    logger.info(event)
+    logger.debug("# EVENT: %s", event)
 
     bucket = event["Records"][0]["s3"]["bucket"]["name"]
     key = event["Records"][0]["s3"]["object"]["key"]
@@ -59,22 +69,22 @@ def lambda_handler(event, context):
             OutputKey=f"transcription/{job_name}.json"
         )
 
-        logger.info(f"Response: {response}")
+        logger.info("Response: %s", response)
         if response["ResponseMetadata"]["HTTPStatusCode"] != 200:
-            logger.error(f"Transcribe job creation failed: {job_name}")
+            logger.error("Transcribe job creation failed: %s", job_name)
             return {
                 "statusCode": response["ResponseMetadata"]["HTTPStatusCode"],
                 "body": job_name
             }
 
-        logger.info(f"Transcribe job created: {job_name}")
+        logger.info("Transcribe job created: %s", job_name)
         return {
             "statusCode": 200,
             "body": job_name
         }
 
     except Exception as e:
-        logger.error(f"An error occurred: {e}")
+        logger.error("An error occurred: %s", e)
         return {
             "statusCode": 500,
             "body": str(e)
@@ -8,9 +8,14 @@ from aws_cdk import (
     aws_iam as iam,
     aws_ec2 as ec2,
     aws_logs as logs,
+    aws_cloudwatch as cloudwatch,
 
     aws_events as events,
     aws_events_targets as targets,
+    aws_sqs as sqs,
+    aws_bedrock as bedrock,
+    aws_stepfunctions as sfn,
+    aws_stepfunctions_tasks as tasks,
     aws_s3_notifications as s3_notifications,
     
     Duration,
@@ -18,6 +23,7 @@ from aws_cdk import (
 )
 
 import aws_cdk.aws_lambda_event_sources as eventsources
+import aws_cdk.aws_lambda_python_alpha as lambda_python
 
 from constructs import Construct
 
@@ -58,14 +64,83 @@ class SummarizerStack(Stack):
             policy_name="BedrockRuntimePolicy",
             statements=[               
                 iam.PolicyStatement(
-                    actions=["bedrock:InvokeModel"],
-                    resources=[f"arn:aws:bedrock:{self.region}::foundation-model/*"]
+                    actions=["bedrock:InvokeModel", "bedrock:InvokeModelWithResponseStream"],
+                    # Cross-region inference profiles (e.g. "us.anthropic...") route requests
+                    # to the foundation model in any of the profile's regions
+                    resources=[
+                        "arn:aws:bedrock:*::foundation-model/*",
+                        f"arn:aws:bedrock:{self.region}:{self.account}:inference-profile/*"
+                    ]
                 )
             ]
         )
 
+        # Set the functions' log level with `cdk deploy -c log_level=DEBUG`
+        self.log_level = self.node.try_get_context("log_level") or "INFO"
+
+        # By default this uses Anthropic Claude 3 Sonnet, but you can change to other
+        # models available to you with `cdk deploy -c model_id=<model-id>`
+        self.model_id = self.node.try_get_context("model_id") or "anthropic.claude-3-sonnet-20240229-v1:0"
+
+        # Opt in to Bedrock batch inference with `cdk deploy -c batch_inference=true`
+        self.batch_inference = str(self.node.try_get_context("batch_inference")).lower() == "true"
+
+        self.dependencies_layer = self.create_dependencies_layer()
+
+        # Opt in to the Step Functions workflow with `cdk deploy -c step_functions=true`
+        self.step_functions = str(self.node.try_get_context("step_functions")).lower() == "true"
+
+        if self.batch_inference and self.step_functions:
+            raise ValueError("batch_inference and step_functions cannot be enabled together")
+
         self.lambda_s3_trigger_function = self.create_lambda_s3_trigger_transcribe_function()
-        self.lambda_eventbridge_bedrock_inference_function = self.create_eventbridge_bedrock_inference_function()
+
+        if self.step_functions:
+            self.summarizer_state_machine = self.create_summarizer_state_machine()
+        else:
+            self.lambda_eventbridge_bedrock_inference_function = self.create_eventbridge_bedrock_inference_function()
+
+        self.failed_jobs_queue = self.create_failed_jobs_queue()
+
+        if self.batch_inference:
+            self.batch_inference_role = self.create_batch_inference_role()
+            self.lambda_batch_inference_function = self.create_batch_inference_function()
+            self.lambda_s3_trigger_batch_output_function = self.create_lambda_s3_trigger_batch_output_function()
+
+    # EventBridge
+    def transcribe_job_event_pattern(self, statuses):
+        """
+        Matches state changes of the Transcribe jobs started by `s3_trigger_transcribe`.
+        """
+        return events.EventPattern(
+            source=["aws.transcribe"],
+            detail_type=["Transcribe Job State Change"],
+            detail={
+                "TranscriptionJobStatus": statuses,
+                "TranscriptionJobName": [{"prefix": "summarizer-"}]
+            }
+        )
+
+    def create_failed_jobs_queue(self):
+        """
+        FAILED Transcribe jobs have nothing to summarize, so instead of invoking a Lambda function they 
+        are sent straight to an SQS queue where they can be inspected or alerted on.
+        """
+        queue = sqs.Queue(
+            self, "TranscribeFailedJobsQueue",
+            retention_period=Duration.days(14)
+        )
+
+        rule = events.Rule(
+            self, "TranscribeFailedRule",
+            event_pattern=self.transcribe_job_event_pattern(["FAILED"])
+        )
+
+        rule.add_target(
+            targets.SqsQueue(queue)
+        )
+
+        return queue
 
     # S3
     def create_bucket(self):
@@ -84,6 +159,24 @@ class SummarizerStack(Stack):
     
         return bucket
 
+    # Lambda layers
+    def create_dependencies_layer(self):
+        """
+        Third-party packages used by the functions are installed from `layer/requirements.txt` into a 
+        shared layer, so each function's asset only contains its handler. boto3 and botocore are left 
+        out since the Lambda runtime already provides them.
+        """
+        layer = lambda_python.PythonLayerVersion(
+            self,
+            "DependenciesLayer",
+            entry=os.path.join(os.getcwd(), "layer"),
+            compatible_runtimes=[lambda_.Runtime.PYTHON_3_12],
+            compatible_architectures=[lambda_.Architecture.ARM_64],
+            removal_policy=RemovalPolicy.DESTROY,
+        )
+
+        return layer
+
     # Lambda functions
     def create_lambda_s3_trigger_transcribe_function(self):
         """
@@ -102,7 +195,9 @@ class SummarizerStack(Stack):
             memory_size=128,
             timeout=Duration.seconds(15),
             environment={
-                "OUTPUT_BUCKET": self.bucket.bucket_name
+                "OUTPUT_BUCKET": self.bucket.bucket_name,
+                "PYTHONDONTWRITEBYTECODE": "1",
+                "LOG_LEVEL": self.log_level
             },
             log_retention=logs.RetentionDays.ONE_WEEK,
         )
@@ -125,9 +220,9 @@ class SummarizerStack(Stack):
 
     def create_eventbridge_bedrock_inference_function(self):
         """
-        This function creates an EventBridge rule that listens for COMPLETED or FAILED Transcribe jobs matching 
-        the `summarizer-` prefix, then formats the transcript, creates a custom prompt, then calls Bedrock for 
-        summarization.
+        This function creates an EventBridge rule that listens for COMPLETED Transcribe jobs matching 
+        the `summarizer-` prefix and queues them in SQS. The function consumes the queue in batches, formats 
+        each transcript, creates a custom prompt, then calls Bedrock for summarization.
         """
         lambda_function = lambda_.Function(
             self,
@@ -135,12 +230,18 @@ class SummarizerStack(Stack):
             function_name="eventbridge-bedrock-inference",
             runtime=lambda_.Runtime.PYTHON_3_12,
             code=lambda_.Code.from_asset(os.path.join(os.getcwd(), "lambda", "eventbridge-bedrock-inference")), 
+            layers=[self.dependencies_layer],
             handler="lambda_function.lambda_handler",
             architecture=lambda_.Architecture.ARM_64,
-            memory_size=128,
-            timeout=Duration.seconds(90), # Note: since this is a synchronous inference job, we extend the default 15s timeout
+            memory_size=1769, # A full vCPU (and proportionally more network throughput) for the parse and S3/Bedrock I/O
+            timeout=Duration.seconds(120), # Note: a batch of 10 messages runs as two rounds of 5 synchronous inference calls
             environment={
-                "OUTPUT_BUCKET": self.bucket.bucket_name
+                "OUTPUT_BUCKET": self.bucket.bucket_name,
+                "MODEL_ID": self.model_id,
+                "BATCH_INFERENCE": str(self.batch_inference).lower(),
+                "PERFORMANCE_LATENCY": self.node.try_get_context("performance_latency") or "standard",
+                "PYTHONDONTWRITEBYTECODE": "1",
+                "LOG_LEVEL": self.log_level
             },
             log_retention=logs.RetentionDays.ONE_WEEK,
         )
@@ -151,7 +252,6 @@ class SummarizerStack(Stack):
 
         # Attach shared policies
         lambda_function.role.attach_inline_policy(self.s3_policy)
-        lambda_function.role.attach_inline_policy(self.transcribe_policy)
         lambda_function.role.attach_inline_policy(self.bedrock_runtime_policy)
        
         # Event bridge rule/trigger for the function
@@ -162,24 +262,288 @@ class SummarizerStack(Stack):
 
         rule = events.Rule(
             self, "TranscribeRule",
-            event_pattern=events.EventPattern(
-                source=["aws.transcribe"],
-                detail_type=["Transcribe Job State Change"],
-                detail={
-                    "TranscriptionJobStatus": ["COMPLETED", "FAILED"],
-                    "TranscriptionJobName": [{"prefix": "summarizer-"}]
-                }
+            event_pattern=self.transcribe_job_event_pattern(["COMPLETED"])
+        )
+
+        # Queue the events so that bursts of completed jobs are coalesced into batched invocations
+        dead_letter_queue = sqs.Queue(
+            self, "TranscribeEventsDeadLetterQueue",
+            retention_period=Duration.days(14)
+        )
+
+        queue = sqs.Queue(
+            self, "TranscribeEventsQueue",
+            visibility_timeout=Duration.seconds(6 * 120), # AWS recommends 6x the function timeout
+            dead_letter_queue=sqs.DeadLetterQueue(
+                max_receive_count=5, # Leaves room for Bedrock throttling to clear before a message is given up on
+                queue=dead_letter_queue
+            )
+        )
+
+        # Messages in the dead-letter queue have no summary, see "Failed summaries" in the README to redrive them
+        dead_letter_queue.metric_approximate_number_of_messages_visible().create_alarm(
+            self, "TranscribeEventsDeadLetterAlarm",
+            alarm_description="Transcribe jobs could not be summarized, redrive TranscribeEventsDeadLetterQueue once the cause is fixed",
+            threshold=1,
+            evaluation_periods=1,
+            comparison_operator=cloudwatch.ComparisonOperator.GREATER_THAN_OR_EQUAL_TO_THRESHOLD
+        )
+
+        rule.add_target(
+            targets.SqsQueue(queue)
+        )
+
+        # Each invocation runs up to MAX_CONCURRENCY (5) Bedrock calls, so this caps the calls in
+        # flight at 5x `-c sqs_max_concurrency=<n>` (2, the minimum, by default). Raise it in line
+        # with your Bedrock requests-per-minute quota.
+        lambda_function.add_event_source(eventsources.SqsEventSource(queue,
+            batch_size=10,
+            max_batching_window=Duration.seconds(20),
+            max_concurrency=int(self.node.try_get_context("sqs_max_concurrency") or 2),
+            report_batch_item_failures=True
+        ))
+
+        return lambda_function
+
+    # Bedrock batch inference
+    def create_batch_inference_role(self):
+        """
+        The service role Bedrock assumes to read the batch manifest from `batch-input` and
+        write the results to `batch-output`.
+        """
+        role = iam.Role(
+            self,
+            "BatchInferenceRole",
+            assumed_by=iam.ServicePrincipal(
+                "bedrock.amazonaws.com",
+                conditions={"StringEquals": {"aws:SourceAccount": self.account}}
+            ),
+        )
+
+        self.bucket.grant_read(role, "batch-input/*")
+        self.bucket.grant_put(role, "batch-output/*")
+        role.add_to_policy(
+            iam.PolicyStatement(
+                actions=["s3:ListBucket"],
+                resources=[self.bucket.bucket_arn]
+            )
+        )
+
+        return role
+
+    def create_batch_inference_function(self):
+        """
+        This function runs on a schedule, collects the records queued by `eventbridge-bedrock-inference`
+        under `batch-input/pending/` into a manifest, and starts a Bedrock batch inference job. The
+        interval can be set with `-c batch_interval_minutes=<n>` and the minimum number of records per job with
+        `-c batch_min_records=<n>`. Records that have been pending for longer than `-c batch_max_wait_minutes=<n>`
+        (4 intervals by default) are summarized with on-demand inference instead.
+        """
+        interval = int(self.node.try_get_context("batch_interval_minutes") or 15)
+        min_records = int(self.node.try_get_context("batch_min_records") or 100)
+        max_wait = int(self.node.try_get_context("batch_max_wait_minutes") or 4 * interval)
+
+        lambda_function = lambda_.Function(
+            self,
+            "BatchInference",
+            function_name="batch-inference",
+            runtime=lambda_.Runtime.PYTHON_3_12,
+            code=lambda_.Code.from_asset(os.path.join(os.getcwd(), "lambda", "batch-inference")), 
+            handler="lambda_function.lambda_handler",
+            architecture=lambda_.Architecture.ARM_64,
+            memory_size=128,
+            timeout=Duration.minutes(5), # Leaves room for on-demand summaries of stale records
+            reserved_concurrent_executions=1, # Only one run may collect the pending records at a time
+            environment={
+                "OUTPUT_BUCKET": self.bucket.bucket_name,
+                "BATCH_ROLE_ARN": self.batch_inference_role.role_arn,
+                "MODEL_ID": self.model_id,
+                "BATCH_MIN_RECORDS": str(min_records),
+                "BATCH_MAX_WAIT_MINUTES": str(max_wait),
+                "PYTHONDONTWRITEBYTECODE": "1",
+                "LOG_LEVEL": self.log_level
+            },
+            log_retention=logs.RetentionDays.ONE_WEEK,
+        )
+
+        lambda_function.apply_removal_policy(
+            RemovalPolicy.DESTROY
+        )
+
+        # Attach shared policies
+        lambda_function.role.attach_inline_policy(self.s3_policy)
+        lambda_function.role.attach_inline_policy(self.bedrock_runtime_policy)
+        lambda_function.role.add_to_principal_policy(
+            iam.PolicyStatement(
+                actions=["bedrock:CreateModelInvocationJob"],
+                resources=[
+                    f"arn:aws:bedrock:{self.region}::foundation-model/*",
+                    f"arn:aws:bedrock:{self.region}:{self.account}:model-invocation-job/*"
+                ]
+            )
+        )
+        lambda_function.role.add_to_principal_policy(
+            iam.PolicyStatement(
+                actions=["bedrock:ListModelInvocationJobs"], # Finds failed jobs whose records need requeuing
+                resources=["*"]
             )
         )
+        self.batch_inference_role.grant_pass_role(lambda_function.role)
+
+        rule = events.Rule(
+            self, "BatchInferenceSchedule",
+            schedule=events.Schedule.rate(Duration.minutes(interval))
+        )
 
         rule.add_target(
-            targets.LambdaFunction(lambda_function) 
+            targets.LambdaFunction(lambda_function)
+        )
+
+        return lambda_function
+
+    def create_lambda_s3_trigger_batch_output_function(self):
+        """
+        This function will listen to the `batch-output` subdir of the S3 bucket for the results of a
+        Bedrock batch inference job, and write each summary to the `processed` subdir.
+        """
+        lambda_function = lambda_.Function(
+            self,
+            "S3TriggerBatchOutput",
+            function_name="s3_trigger_batch_output",
+            runtime=lambda_.Runtime.PYTHON_3_12,
+            code=lambda_.Code.from_asset(os.path.join(os.getcwd(), "lambda", "s3-trigger-batch-output")), 
+            handler="lambda_function.lambda_handler",
+            architecture=lambda_.Architecture.ARM_64,
+            memory_size=128,
+            timeout=Duration.seconds(60),
+            environment={
+                "OUTPUT_BUCKET": self.bucket.bucket_name,
+                "PYTHONDONTWRITEBYTECODE": "1",
+                "LOG_LEVEL": self.log_level
+            },
+            log_retention=logs.RetentionDays.ONE_WEEK,
         )
 
-        lambda_function.add_permission(
-            "AllowEventBridgeInvocation",
-            principal=iam.ServicePrincipal("events.amazonaws.com"),
-            source_arn=rule.rule_arn
+        lambda_function.apply_removal_policy(
+            RemovalPolicy.DESTROY
         )
 
+        # Attach the shared policies
+        lambda_function.role.attach_inline_policy(self.s3_policy)
+
+        # Event source
+        lambda_function.add_event_source(eventsources.S3EventSource(self.bucket,
+            events=[s3.EventType.OBJECT_CREATED],
+            filters=[s3.NotificationKeyFilter(prefix="batch-output/", suffix=".jsonl.out")]
+        ))
+
         return lambda_function
+
+    # Step Functions
+    def create_summarizer_state_machine(self):
+        """
+        This creates an Express state machine that replaces the `eventbridge-bedrock-inference` function. A 
+        small Lambda function converts the transcript and builds the prompt, then the state machine invokes 
+        Bedrock and writes the summary to S3 through its service integrations, so no Lambda is billed while 
+        waiting on the model. The request body is passed between states, so transcripts are limited to the 
+        256 KB Step Functions payload size. Jobs that already have a summary in `processed/` are skipped, 
+        and failed executions are logged to CloudWatch.
+        """
+        lambda_function = lambda_.Function(
+            self,
+            "StepFunctionsParseTranscript",
+            function_name="step-functions-parse-transcript",
+            runtime=lambda_.Runtime.PYTHON_3_12,
+            code=lambda_.Code.from_asset(os.path.join(os.getcwd(), "lambda", "eventbridge-bedrock-inference")), 
+            layers=[self.dependencies_layer],
+            handler="lambda_function.parse_handler",
+            architecture=lambda_.Architecture.ARM_64,
+            memory_size=1769,
+            timeout=Duration.seconds(30),
+            environment={
+                "OUTPUT_BUCKET": self.bucket.bucket_name,
+                "PYTHONDONTWRITEBYTECODE": "1",
+                "LOG_LEVEL": self.log_level
+            },
+            log_retention=logs.RetentionDays.ONE_WEEK,
+        )
+
+        lambda_function.apply_removal_policy(
+            RemovalPolicy.DESTROY
+        )
+
+        # Attach shared policies
+        lambda_function.role.attach_inline_policy(self.s3_policy)
+
+        parse = tasks.LambdaInvoke(
+            self, "ConvertTranscript",
+            lambda_function=lambda_function,
+            payload_response_only=True,
+            result_path="$.parsed"
+        )
+
+        summarize = tasks.BedrockInvokeModel(
+            self, "Summarize",
+            model=bedrock.FoundationModel.from_foundation_model_id(
+                self, "SummarizerModel",
+                bedrock.FoundationModelIdentifier(self.model_id)
+            ),
+            body=sfn.TaskInput.from_json_path_at("$.parsed.body"),
+            result_selector={"summary.$": "$.Body.content[0].text"},
+            result_path="$.summarized"
+        )
+
+        summarize.add_retry(
+            errors=["Bedrock.ThrottlingException", "Bedrock.ServiceUnavailableException"],
+            interval=Duration.seconds(2),
+            max_attempts=5,
+            backoff_rate=2,
+            jitter_strategy=sfn.JitterType.FULL
+        )
+
+        write_summary = tasks.CallAwsService(
+            self, "WriteSummary",
+            service="s3",
+            action="putObject",
+            parameters={
+                "Bucket": self.bucket.bucket_name,
+                "Key": sfn.JsonPath.string_at("$.parsed.processed_key"),
+                "Body": sfn.JsonPath.string_at("$.summarized.summary")
+            },
+            iam_resources=[self.bucket.arn_for_objects("processed/*")]
+        )
+
+        # EventBridge may deliver the same event more than once, skip jobs that
+        # have already been summarized
+        already_summarized = sfn.Choice(self, "AlreadySummarized").when(
+            sfn.Condition.boolean_equals("$.parsed.cached", True),
+            sfn.Succeed(self, "SummaryExists")
+        ).otherwise(summarize.next(write_summary))
+
+        log_group = logs.LogGroup(
+            self, "SummarizerStateMachineLogs",
+            retention=logs.RetentionDays.ONE_WEEK,
+            removal_policy=RemovalPolicy.DESTROY
+        )
+
+        state_machine = sfn.StateMachine(
+            self, "SummarizerStateMachine",
+            state_machine_type=sfn.StateMachineType.EXPRESS,
+            definition_body=sfn.DefinitionBody.from_chainable(parse.next(already_summarized)),
+            timeout=Duration.minutes(5),
+            logs=sfn.LogOptions(
+                destination=log_group,
+                level=sfn.LogLevel.ERROR
+            )
+        )
+
+        rule = events.Rule(
+            self, "TranscribeRule",
+            event_pattern=self.transcribe_job_event_pattern(["COMPLETED"])
+        )
+
+        rule.add_target(
+            targets.SfnStateMachine(state_machine)
+        )
+
+        return state_machine